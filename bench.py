@@ -0,0 +1,334 @@
+"""Offline benchmarks for the bot's handlers against synthetic catalogs.
+
+Usage:
+    python bench.py                                  # 100, 10k and 100k lectures
+    python bench.py --sizes 100,10000 --iterations 500 --output bench-results.json
+
+For each size a synthetic lectures.json is written to a temporary directory
+(with some subjects still in the legacy "lectures" format, so startup
+includes the schema migration, also timed on its own), main.py is
+imported fresh against it, and the real handlers are driven with fake
+updates and a stub Bot that only records API calls; nothing talks to
+Telegram. Per operation it reports p50/p95/p99 latency, peak bytes
+allocated and bytes read/written, and writes everything to a JSON file so
+runs from different versions can be compared.
+"""
+
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from types import SimpleNamespace as NS
+
+import telegram.ext  # noqa: F401  imported up front so "load" times only the catalog
+
+REPO_DIR = Path(__file__).resolve().parent
+
+WORDS = [
+    "Introduction", "Receptors", "Pharmacokinetics", "Pharmacodynamics", "Antibiotics", "Enzymes",
+    "Alkaloids", "Glycosides", "Flavonoids", "Chromatography", "Spectroscopy", "Titration", "Tablets",
+    "Suspensions", "Emulsions", "Bacteria", "Viruses", "Fungi", "Immunology", "Sterilization",
+    "Analgesics", "Anticoagulants", "Diuretics", "Hormones", "Vitamins", "Toxicology", "Lecture",
+    "Section", "Revision", "Chapter", "Part", "Summary", "الكيمياء", "المحاضرة", "الأدوية",
+]
+
+# ---------- SYNTHETIC DATA ----------
+
+def make_title(rng, number):
+    words = rng.sample(WORDS, rng.randint(2, 7))
+    extension = rng.choice([".pdf", ".pdf", ".pptx", ".mp4", ".m4a", ""])
+    return f"{' '.join(words)} {number}{extension}"
+
+def make_catalog(size, seed=1):
+    """A lectures.json dict with `size` lectures spread over size/250 subjects (at least 5)."""
+    rng = random.Random(seed)
+    num_subjects = max(5, size // 250)
+    data = {"_stats": {"total_forwards": 0}}
+    subjects = [f"Subject {i:03d}" for i in range(num_subjects)]
+    for i, name in enumerate(subjects):
+        # Every tenth subject predates the document/media split
+        if i % 10 == 9:
+            data[name] = {"thread_id": 1000 + i, "lectures": {}}
+        else:
+            data[name] = {"thread_id": 1000 + i, "document_lectures": {}, "media_lectures": {}}
+
+    for number in range(size):
+        info = data[subjects[number % num_subjects]]
+        title = make_title(rng, number)
+        message_id = 10_000 + number
+        if "lectures" in info:
+            info["lectures"][title] = message_id  # legacy bare message_id
+        elif title.endswith((".mp4", ".m4a")):
+            info["media_lectures"][title] = message_id
+        else:
+            info["document_lectures"][title] = message_id
+    return data
+
+# ---------- FAKE TELEGRAM ----------
+
+class StubBot:
+    """Records every Bot API call and returns just enough for the handlers."""
+
+    def __init__(self):
+        self.calls = 0
+        self._message_id = 0
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        async def method(*args, **kwargs):
+            self.calls += 1
+            self._message_id += 1
+            if name == "send_media_group":
+                return [NS(message_id=self._message_id)] * len(kwargs.get("media", ()))
+            return NS(message_id=self._message_id)
+        return method
+
+class FakeMessage:
+    def __init__(self, bot, chat, user, text="", message_id=1, reply_to=None, **attachments):
+        self.bot = bot
+        self.chat = chat
+        self.chat_id = chat.id
+        self.from_user = user
+        self.text = text
+        self.caption = None
+        self.message_id = message_id
+        self.message_thread_id = None
+        self.reply_to_message = reply_to
+        for kind in ("document", "video", "audio", "voice", "animation", "photo"):
+            setattr(self, kind, attachments.get(kind))
+
+    async def reply_text(self, *args, **kwargs):
+        self.bot.calls += 1
+        return NS(message_id=0, edit_text=self._edit)
+
+    async def _edit(self, *args, **kwargs):
+        self.bot.calls += 1
+
+class FakeQuery:
+    def __init__(self, bot, data, user, chat):
+        self.bot = bot
+        self.data = data
+        self.from_user = user
+        self.message = NS(message_id=1, chat_id=chat.id, chat=chat)
+
+    async def answer(self, *args, **kwargs):
+        self.bot.calls += 1
+
+    async def edit_message_text(self, *args, **kwargs):
+        self.bot.calls += 1
+
+def command_update(bot, user, chat, text="", reply_to=None):
+    message = FakeMessage(bot, chat, user, text, reply_to=reply_to)
+    return NS(message=message, effective_message=message, effective_user=user, effective_chat=chat, callback_query=None)
+
+def callback_update(bot, user, chat, data):
+    return NS(message=None, effective_user=user, effective_chat=chat, callback_query=FakeQuery(bot, data, user, chat))
+
+def fake_context(bot, args=()):
+    return NS(bot=bot, args=list(args), user_data={}, chat_data={}, bot_data={})
+
+# ---------- MEASUREMENT ----------
+
+def io_counters():
+    """(bytes read, bytes written) by this process so far, or (None, None) off Linux."""
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+def percentiles(samples):
+    if len(samples) < 2:
+        return samples[0], samples[0], samples[0]
+    cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return cuts[49], cuts[94], cuts[98]
+
+async def measure(name, make_call, iterations, alloc_iterations):
+    """Run `await make_call(i)` repeatedly; return a result row for operation `name`."""
+    await make_call(-1)  # warm up caches and lazy imports
+
+    read_before, written_before = io_counters()
+    latencies = []
+    for i in range(iterations):
+        started = time.perf_counter()
+        await make_call(i)
+        latencies.append((time.perf_counter() - started) * 1000)
+    read_after, written_after = io_counters()
+
+    # Allocation tracing slows everything down, so it gets its own, shorter pass
+    peaks = []
+    tracemalloc.start()
+    for i in range(alloc_iterations):
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        await make_call(iterations + i)
+        peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+
+    p50, p95, p99 = percentiles(latencies)
+    row = {
+        "op": name,
+        "iterations": iterations,
+        "p50_ms": round(p50, 4),
+        "p95_ms": round(p95, 4),
+        "p99_ms": round(p99, 4),
+        "mean_ms": round(statistics.fmean(latencies), 4),
+        "alloc_peak_bytes": round(statistics.fmean(peaks)) if peaks else None,
+        "bytes_read": None,
+        "bytes_written": None,
+    }
+    if read_before is not None:
+        row["bytes_read"] = round((read_after - read_before) / iterations)
+        row["bytes_written"] = round((written_after - written_before) / iterations)
+    return row
+
+def single_run(name, elapsed_ms, bytes_read=None):
+    """Result row for an operation that is only timed once (startup work)."""
+    ms = round(elapsed_ms, 4)
+    return {"op": name, "iterations": 1, "p50_ms": ms, "p95_ms": ms, "p99_ms": ms, "mean_ms": ms,
+            "alloc_peak_bytes": None, "bytes_read": bytes_read, "bytes_written": None}
+
+# ---------- BENCHMARKS ----------
+
+def load_main():
+    """Import main.py fresh in the current directory, with the outbound rate limits lifted."""
+    sys.modules.pop("main", None)
+    if str(REPO_DIR) not in sys.path:
+        sys.path.insert(0, str(REPO_DIR))
+    main = importlib.import_module("main")
+    main.SEND_GLOBAL_RATE = main.SEND_CHAT_RATE = main.SEND_GROUP_RATE = main.SEND_CHAT_BURST = 1e9
+    main.outbox = main.SendQueue()
+    return main
+
+async def run_size(size, iterations, alloc_iterations):
+    workdir = tempfile.mkdtemp(prefix=f"bench-{size}-")
+    os.chdir(workdir)
+    catalog_text = json.dumps(make_catalog(size), ensure_ascii=False)
+    Path("lectures.json").write_text(catalog_text, encoding="utf-8")
+
+    read_before, _ = io_counters()
+    started = time.perf_counter()
+    main = load_main()
+    load_ms = (time.perf_counter() - started) * 1000
+    read_after, _ = io_counters()
+
+    # The schema upgrade on its own (load above includes it, plus parsing and saving)
+    legacy = json.loads(catalog_text)
+    started = time.perf_counter()
+    main.migrate_catalog(legacy)
+    migrate_ms = (time.perf_counter() - started) * 1000
+
+    bot = StubBot()
+    admin = NS(id=main.ADMIN_IDS[0], first_name="Admin", username="admin")
+    private = NS(id=admin.id, username=None, type="private")
+    group_id = main.GROUP_ID
+    group = NS(id=-100 if group_id.startswith("@") else int(group_id),
+               username=group_id[1:] if group_id.startswith("@") else None, type="supergroup")
+
+    rng = random.Random(2)
+    subject_keys = [main.encode_id(subject_id) for subject_id, _ in main.catalog.subjects()]
+    lecture_keys = [main.encode_id(lecture["id"]) for lecture in main.catalog.iter_lectures()]
+    queries = [rng.choice(WORDS)[:rng.randint(3, 8)] for _ in range(50)]
+
+    async def start(i):
+        await main.start(command_update(bot, admin, private, "/start"), fake_context(bot))
+
+    async def search(i):
+        query = queries[i % len(queries)]
+        await main.search(command_update(bot, admin, private, f"/search {query}"), fake_context(bot, [query]))
+
+    def callback(make_data):
+        async def call(i):
+            await main.router.dispatch(callback_update(bot, admin, private, make_data(i)), fake_context(bot))
+        return call
+
+    async def capture(i):
+        number = size + 1_000_000 + i
+        attachment = NS(file_id=f"F{number}", file_unique_id=f"U{number}", file_name=f"{make_title(rng, number)}.pdf",
+                        mime_type="application/pdf", file_size=1_000_000, duration=None)
+        source = FakeMessage(bot, group, admin, message_id=number, document=attachment)
+        update = command_update(bot, admin, group, "/capture", reply_to=source)
+        await main.capture(update, fake_context(bot, ["Subject", "000"]))
+
+    async def flush(i):
+        main.catalog.dirty = True
+        await main.catalog.flush()
+
+    operations = [
+        ("start", start),
+        ("search", search),
+        ("callback:subject", callback(lambda i: f"subject|{subject_keys[i % len(subject_keys)]}")),
+        ("callback:type_menu", callback(lambda i: f"type_menu|{subject_keys[i % len(subject_keys)]}|document")),
+        ("callback:lecture", callback(lambda i: f"lecture|{lecture_keys[i % len(lecture_keys)]}")),
+        ("capture", capture),
+        ("flush", flush),
+    ]
+
+    rows = [
+        single_run("load", load_ms, read_after - read_before if read_before is not None else None),
+        single_run("migrate", migrate_ms),
+    ]
+    for name, make_call in operations:
+        # Snapshots rewrite the whole file, so they get fewer rounds
+        rounds = max(3, iterations // 20) if name == "flush" else iterations
+        rows.append(await measure(name, make_call, rounds, min(alloc_iterations, rounds)))
+
+    await main.outbox.close()
+    await main.quiz_jobs.close()
+    await main.catalog.close()
+    os.chdir(REPO_DIR)
+    shutil.rmtree(workdir, ignore_errors=True)
+    for row in rows:
+        row["size"] = size
+    return rows
+
+def git_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="100,10000,100000", help="comma-separated catalog sizes")
+    parser.add_argument("--iterations", type=int, default=200, help="timed calls per operation")
+    parser.add_argument("--alloc-iterations", type=int, default=20, help="calls per operation traced for allocations")
+    parser.add_argument("--output", default="bench-results.json", help="where to write the JSON results")
+    args = parser.parse_args()
+
+    output = Path(args.output).resolve()
+    results = []
+    for size in (int(s) for s in args.sizes.split(",")):
+        rows = asyncio.run(run_size(size, args.iterations, args.alloc_iterations))
+        results.extend(rows)
+        for row in rows:
+            print(f"{size:>7} {row['op']:<20} p50 {row['p50_ms']:>9.3f} ms  p95 {row['p95_ms']:>9.3f} ms  "
+                  f"p99 {row['p99_ms']:>9.3f} ms  alloc {row['alloc_peak_bytes'] or 0:>10} B")
+
+    report = {
+        "version": git_version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "results": results,
+    }
+    output.write_text(json.dumps(report, indent=2), encoding="utf-8")
+    print(f"Wrote {output}")
+
+if __name__ == "__main__":
+    main()
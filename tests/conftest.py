@@ -0,0 +1,43 @@
+import importlib
+import sys
+from pathlib import Path
+
+import pytest
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture
+def main(tmp_path, monkeypatch):
+    """main.py imported fresh with its data files in a temporary directory."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.syspath_prepend(str(REPO_DIR))
+    sys.modules.pop("main", None)
+    module = importlib.import_module("main")
+    yield module
+    sys.modules.pop("main", None)
+
+
+class FakeBot:
+    """Records Bot API calls; `fail` maps a method name to exceptions raised on its next calls."""
+
+    def __init__(self):
+        self.calls = []
+        self.fail = {}
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        async def method(**kwargs):
+            self.calls.append((name, kwargs))
+            errors = self.fail.get(name)
+            if errors:
+                raise errors.pop(0)
+            return {"method": name, **kwargs}
+        return method
+
+
+@pytest.fixture
+def bot():
+    return FakeBot()
@@ -0,0 +1,59 @@
+import asyncio
+
+
+def capture(main, title, message_id):
+    lecture = {"subject": "Pharmacology", "content_type": "document", "title": title,
+               "message_id": message_id, "thread_id": None, "file": None}
+    [(_, saved_title)] = asyncio.run(main.capture_lectures([lecture]))
+    return saved_title
+
+
+def test_repeated_captures_get_distinct_titles(main):
+    titles = [capture(main, "Intro.pdf", 7) for _ in range(4)]
+    assert titles == ["Intro.pdf", "Intro.pdf (7)", "Intro.pdf (7, 2)", "Intro.pdf (7, 3)"]
+    assert len(main.catalog.lectures("Pharmacology", "document")) == 4
+
+
+def test_auto_capture_ignores_non_admins(main):
+    from types import SimpleNamespace as NS
+    group = NS(id=-100123, username=main.GROUP_ID.lstrip("@"), type="supergroup")
+    main.catalog.add_subject("Anatomy", thread_id=77)
+
+    def post(user_id, message_id):
+        video = NS(file_id=f"V{message_id}", file_unique_id=f"U{message_id}", file_name=f"{message_id}.mp4",
+                   mime_type="video/mp4", file_size=1, duration=3)
+        msg = NS(message_id=message_id, message_thread_id=77, from_user=NS(id=user_id), sender_chat=None,
+                 caption=None, video=video, document=None, audio=None, voice=None, animation=None)
+        return NS(effective_message=msg, effective_chat=group)
+
+    async def run():
+        await main.auto_capture(post(12345, 1), None)
+        await main.auto_capture(post(main.ADMIN_IDS[0], 2), None)
+        return {key: len(lectures) for key, lectures in main.capture_batcher._pending.items()}
+
+    assert asyncio.run(run()) == {"default": 1}
+
+
+def test_failed_auto_capture_is_retried_with_the_next_batch(main, monkeypatch):
+    capture_lectures = main.capture_lectures
+    errors = [main.sqlite3.OperationalError("database is locked")]
+
+    async def flaky(lectures):
+        if errors:
+            raise errors.pop()
+        return await capture_lectures(lectures)
+
+    monkeypatch.setattr(main, "capture_lectures", flaky)
+    lecture = {"subject": "Pharmacology", "content_type": "document", "title": "Intro.pdf",
+               "message_id": 7, "thread_id": None, "file": None}
+
+    async def run():
+        batcher = main.CaptureBatcher(delay=0)
+        batcher.add(lecture)
+        await batcher.flush()
+        assert main.catalog.lectures("Pharmacology", "document") == {}
+        await batcher.flush()
+        batcher._timer.cancel()
+
+    asyncio.run(run())
+    assert list(main.catalog.lectures("Pharmacology", "document")) == ["Intro.pdf"]
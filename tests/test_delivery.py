@@ -0,0 +1,56 @@
+import asyncio
+from types import SimpleNamespace as NS
+
+from telegram import MessageEntity
+
+
+def post(caption=None, entities=None):
+    document = NS(file_id="F1", file_unique_id="U1", mime_type="application/pdf", file_size=10)
+    return NS(document=document, caption=caption, caption_entities=entities or ())
+
+
+def deliver(main, bot, lectures):
+    async def run():
+        sent = await main.deliver_lectures(bot, 42, lectures)
+        await main.outbox.close()
+        return sent
+    return asyncio.run(run())
+
+
+def test_cached_send_repeats_the_posts_caption(main, bot):
+    link = MessageEntity(MessageEntity.TEXT_LINK, 0, 6, url="https://example.com/slides")
+    file = main.file_info(post("Slides for week 1", [link]))
+    lecture = {"id": 1, "subject": "Anatomy", "content_type": "document", "title": "week1.pdf",
+               "message_id": 5, "file": file}
+
+    assert deliver(main, bot, [lecture]) == 1
+    [(method, kwargs)] = bot.calls
+    assert method == "send_document"
+    assert kwargs["caption"] == "Slides for week 1"
+    assert kwargs["caption_entities"] == (link,)
+
+
+def test_post_without_caption_is_sent_without_one(main, bot):
+    lecture = {"id": 1, "subject": "Anatomy", "content_type": "document", "title": "week1.pdf",
+               "message_id": 5, "file": main.file_info(post())}
+
+    deliver(main, bot, [lecture])
+    [(_, kwargs)] = bot.calls
+    assert kwargs["caption"] is None
+
+
+def test_caption_survives_sqlite_and_its_migration(main):
+    link = MessageEntity(MessageEntity.BOLD, 0, 6)
+    file = main.file_info(post("Slides for week 1", [link]))
+    catalog = main.SqliteStorage("catalog.db")
+    catalog.add_lecture("Anatomy", "document", "week1.pdf", 5, file=file)
+    assert catalog.get_lecture("Anatomy", "document", "week1.pdf")["file"] == file
+
+    # A database from before captions were kept
+    catalog.conn.execute("ALTER TABLE lectures DROP COLUMN caption")
+    catalog.conn.execute("ALTER TABLE lectures DROP COLUMN caption_entities")
+    catalog.conn.execute("PRAGMA user_version = 2")
+    catalog.conn.close()
+    upgraded = main.SqliteStorage("catalog.db")
+    assert upgraded.get_lecture("Anatomy", "document", "week1.pdf")["file"]["caption"] is None
+    assert upgraded.conn.execute("PRAGMA user_version").fetchone()[0] == main.sqlite_migrations.latest
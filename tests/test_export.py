@@ -0,0 +1,54 @@
+import asyncio
+import io
+from types import SimpleNamespace as NS
+
+import pytest
+
+
+@pytest.mark.parametrize("fmt", ["jsonl", "csv"])
+def test_export_then_import_restores_the_catalog(main, fmt):
+    catalog = main.catalog
+    catalog.add_subject("Anatomy", thread_id=5)
+    catalog.add_lecture("Anatomy", "document", "Intro, part 1.pdf", 7, thread_id=5,
+                        file={"kind": "document", "file_id": "F", "file_unique_id": "U",
+                              "mime_type": "application/pdf", "file_size": 1024, "duration": None})
+    catalog.add_lecture("Anatomy", "media", 'Dissection "live".mp4', 8, thread_id=5)
+
+    async def run():
+        before = list(main.iter_catalog_rows())
+        out = io.StringIO()
+        assert await main.export_catalog(out, fmt) == 2
+        for subject in catalog.subject_names():
+            catalog.delete_subject(subject)
+
+        out.seek(0)
+        report = await main.import_catalog(main.read_catalog_rows(out, fmt))
+        assert (report["imported"], report["invalid"]) == (2, 0)
+        assert list(main.iter_catalog_rows()) == before
+
+        out.seek(0)
+        again = await main.import_catalog(main.read_catalog_rows(out, fmt))
+        assert (again["imported"], again["duplicates"]) == (0, 2)
+
+    asyncio.run(run())
+
+
+def test_failed_import_is_reported(main):
+    edits = []
+
+    async def reply_text(text, **kwargs):
+        async def edit_text(text, **kwargs):
+            edits.append(text)
+        return NS(edit_text=edit_text)
+
+    async def get_file(file_id):
+        async def download_to_drive(path):
+            path.write_bytes(b"\xff\xfe not UTF-8")
+        return NS(download_to_drive=download_to_drive)
+
+    document = NS(file_id="F", file_name="lectures.jsonl", file_size=100)
+    message = NS(reply_text=reply_text, reply_to_message=NS(document=document))
+    update = NS(effective_user=NS(id=main.ADMIN_IDS[0]), message=message)
+    asyncio.run(main.import_command(update, NS(bot=NS(get_file=get_file), args=[])))
+
+    assert edits and edits[-1].startswith("❌ Import failed")
@@ -0,0 +1,9 @@
+def test_ids_round_trip(main):
+    for n in (0, 61, 62, 12345, 2 ** 63 - 1):
+        assert main.decode_id(main.encode_id(n)) == n
+
+
+def test_pre_id_payloads_and_oversized_ids_are_rejected(main):
+    # Subject names from buttons made before ids existed, and anything past SQLite's INTEGER range
+    for text in ("Pharmacology", "Microbiology", "zzzzzzzzzzz", "", "3-x"):
+        assert main.decode_id(text) is None
@@ -0,0 +1,65 @@
+import asyncio
+
+
+def open_catalog(main):
+    return main.JsonStorage("catalog.json", "catalog.journal")
+
+
+def titles(catalog):
+    return sorted(lecture["title"] for lecture in catalog.iter_lectures())
+
+
+def test_unflushed_changes_are_replayed_from_the_journal(main):
+    catalog = open_catalog(main)
+    catalog.add_subject("Pharmacology")
+    catalog.add_lecture("Pharmacology", "document", "Intro.pdf", 7)
+    catalog._journal.close()  # a crash: no snapshot was written
+
+    reopened = open_catalog(main)
+    assert titles(reopened) == ["Intro.pdf"]
+    assert reopened.get_lecture("Pharmacology", "document", "Intro.pdf")["message_id"] == 7
+
+
+def test_torn_last_record_is_dropped_and_later_appends_survive(main):
+    catalog = open_catalog(main)
+    catalog.add_subject("Pharmacology")
+    catalog.add_lecture("Pharmacology", "document", "Intro.pdf", 7)
+    catalog._journal.write('{"op": "add_lecture", "subj')  # cut off mid-write
+    catalog._journal.close()
+
+    reopened = open_catalog(main)
+    assert titles(reopened) == ["Intro.pdf"]
+    reopened.add_lecture("Pharmacology", "document", "Second.pdf", 8)
+    reopened._journal.close()
+
+    assert titles(open_catalog(main)) == ["Intro.pdf", "Second.pdf"]
+
+
+def test_snapshot_trims_the_journal(main, tmp_path):
+    catalog = open_catalog(main)
+    catalog.add_subject("Pharmacology")
+    catalog.add_lecture("Pharmacology", "document", "Intro.pdf", 7)
+    asyncio.run(catalog.flush())
+
+    assert (tmp_path / "catalog.journal").read_text() == ""
+    catalog.add_lecture("Pharmacology", "document", "Second.pdf", 8)
+    catalog._journal.close()
+    assert titles(open_catalog(main)) == ["Intro.pdf", "Second.pdf"]
+
+
+def test_failed_journal_trim_keeps_the_journal_writable(main, monkeypatch):
+    catalog = open_catalog(main)
+    catalog.add_subject("Pharmacology")
+    write_atomic = main._write_atomic
+
+    def fail_on_journal(path, text):
+        if path == "catalog.journal":
+            raise OSError(28, "No space left on device")
+        write_atomic(path, text)
+
+    monkeypatch.setattr(main, "_write_atomic", fail_on_journal)
+    asyncio.run(catalog.flush())
+    catalog.add_lecture("Pharmacology", "document", "Intro.pdf", 7)
+    catalog._journal.close()
+
+    assert titles(open_catalog(main)) == ["Intro.pdf"]
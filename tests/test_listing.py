@@ -0,0 +1,11 @@
+def test_long_titles_are_cut_before_escaping(main):
+    main.catalog.add_subject("Anatomy")
+    main.catalog.add_lecture("Anatomy", "document", "_" * 5000, 7)
+    main.catalog.add_lecture("Anatomy", "document", "short_name.pdf", 8)
+
+    chunks = list(main.chunk_lines(main.iter_listing(["Anatomy"])))
+    assert all(len(chunk) <= main.LIST_CHUNK_SIZE for chunk in chunks)
+    text = "\n".join(chunks)
+    # Every underscore is still escaped, so no entity is left open
+    assert text.count("_") == text.count("\\_")
+    assert "short\\_name.pdf" in text
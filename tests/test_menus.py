@@ -0,0 +1,33 @@
+import asyncio
+from types import SimpleNamespace as NS
+
+import pytest
+
+
+def tap(main, data):
+    edits = []
+
+    async def answer(*args, **kwargs):
+        pass
+
+    async def edit_message_text(text, **kwargs):
+        edits.append(text)
+
+    query = NS(data=data, answer=answer, edit_message_text=edit_message_text, from_user=NS(id=12345))
+    asyncio.run(main.router.dispatch(NS(callback_query=query), NS(user_data={}, bot=None)))
+    return edits
+
+
+@pytest.mark.parametrize("args", ["", "|photos", "|document_lectures|0"])
+def test_unknown_content_type_is_not_found(main, args):
+    main.catalog.add_lecture("Anatomy", "document", "Intro.pdf", 7)
+    key = main.encode_id(main.catalog.subject_id("Anatomy"))
+    for action in ("type_menu", "send_all"):
+        assert tap(main, f"{action}|{key}{args}") == ["Lecture list not found."]
+
+
+def test_known_content_type_lists_its_lectures(main):
+    main.catalog.add_lecture("Anatomy", "document", "Intro.pdf", 7)
+    key = main.encode_id(main.catalog.subject_id("Anatomy"))
+    [text] = tap(main, f"type_menu|{key}|document")
+    assert "Anatomy" in text
@@ -0,0 +1,30 @@
+import json
+
+
+def test_pre_schema_catalog_is_upgraded_once(main, tmp_path):
+    path = tmp_path / "old.json"
+    path.write_text(json.dumps({
+        "Anatomy": {"lectures": {"Intro.pdf": 7}, "media_lectures": {"Dissection.mp4": 8}},
+        "_stats": {"total_forwards": 3},
+    }))
+
+    catalog = main.JsonStorage(str(path))
+    saved = json.loads(path.read_text())
+    assert saved["_schema_version"] == main.json_migrations.latest
+    assert "lectures" not in saved["Anatomy"]
+    intro = catalog.get_lecture("Anatomy", "document", "Intro.pdf")
+    assert intro["message_id"] == 7 and intro["id"]
+    assert catalog.get_lecture("Anatomy", "media", "Dissection.mp4")["message_id"] == 8
+
+    # Already current: nothing runs and the ids stay put
+    assert not main.migrate_catalog(saved)
+    assert main.JsonStorage(str(path)).get_lecture("Anatomy", "document", "Intro.pdf")["id"] == intro["id"]
+
+
+def test_interrupted_migration_runs_again_cleanly(main):
+    data = {"Anatomy": {"lectures": {"Intro.pdf": 7}}}
+    main.migrate_catalog(data)
+    # As if the upgraded file was never saved: the steps see their own output again
+    data["_schema_version"] = 0
+    main.migrate_catalog(data)
+    assert data["Anatomy"]["document_lectures"] == {"Intro.pdf": {"message_id": 7, "id": 1}}
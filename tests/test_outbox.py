@@ -0,0 +1,73 @@
+import asyncio
+import time
+
+from telegram.error import RetryAfter
+
+
+def test_calls_go_out_in_priority_order(main, bot):
+    async def run():
+        outbox = main.SendQueue()
+        await asyncio.gather(*(
+            outbox.call(chat_id, bot.send_message, chat_id=chat_id, text=str(chat_id), priority=priority)
+            for chat_id, priority in [(1, main.BACKGROUND), (2, main.BACKGROUND), (3, main.INTERACTIVE)]
+        ))
+        await outbox.close()
+
+    asyncio.run(run())
+    assert [kwargs["chat_id"] for _, kwargs in bot.calls] == [3, 1, 2]
+
+
+def test_slow_chat_does_not_hold_up_other_chats(main, bot):
+    async def run():
+        outbox = main.SendQueue()
+        group = -100123  # SEND_GROUP_RATE: only the first SEND_CHAT_BURST go out at once
+        background = [asyncio.create_task(outbox.call(group, bot.send_message, chat_id=group, text="chunk",
+                                                      priority=main.BACKGROUND)) for _ in range(5)]
+        await asyncio.sleep(0.1)  # the group's burst is out, the rest wait for its rate
+        started = time.monotonic()
+        await outbox.call(42, bot.send_message, chat_id=42, text="hi")
+        elapsed = time.monotonic() - started
+        for task in background:
+            task.cancel()
+        await outbox.close()
+        return elapsed
+
+    assert asyncio.run(run()) < 0.5
+    assert [kwargs["chat_id"] for _, kwargs in bot.calls].count(-100123) < 5
+
+
+def test_retry_after_is_retried_and_pauses_sends(main, bot):
+    bot.fail["send_message"] = [RetryAfter(1)]
+
+    async def run():
+        outbox = main.SendQueue()
+        started = time.monotonic()
+        result = await outbox.call(42, bot.send_message, chat_id=42, text="hi")
+        elapsed = time.monotonic() - started
+        await outbox.close()
+        return outbox, result, elapsed
+
+    outbox, result, elapsed = asyncio.run(run())
+    assert result["text"] == "hi"
+    assert len(bot.calls) == 2
+    assert elapsed >= 1
+    assert outbox.metrics()["retries"] == 1 and outbox.metrics()["sent"] == 1
+
+
+def test_retry_after_gives_up_after_max_retries(main, bot, monkeypatch):
+    monkeypatch.setattr(main, "SEND_MAX_RETRIES", 0)
+    bot.fail["send_message"] = [RetryAfter(30)]
+
+    async def run():
+        outbox = main.SendQueue()
+        try:
+            await outbox.call(42, bot.send_message, chat_id=42, text="hi")
+        finally:
+            await outbox.close()
+
+    try:
+        asyncio.run(run())
+    except RetryAfter:
+        pass
+    else:
+        raise AssertionError("RetryAfter was swallowed")
@@ -0,0 +1,73 @@
+import asyncio
+import time
+from types import SimpleNamespace as NS
+
+from telegram.error import BadRequest
+
+LECTURE = {"id": 1, "subject": "Pharmacology", "content_type": "document",
+           "title": "Beta_blockers *intro*", "message_id": 10}
+
+
+class FakeQuery:
+    def __init__(self, fail_first_edit=False):
+        self.edits = []
+        self.fail_first_edit = fail_first_edit
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+    async def edit_message_text(self, text, **kwargs):
+        if self.fail_first_edit:
+            self.fail_first_edit = False
+            raise BadRequest("Can't parse entities")
+        self.edits.append(text)
+
+
+def ask_for_quiz(main, monkeypatch, query, generator_delay=0.5):
+    def slow_generator(title):
+        time.sleep(generator_delay)
+        return main.generate_mock_quiz_payload(title)
+
+    monkeypatch.setattr(main, "quiz_jobs", main.QuizJobs(slow_generator, 2))
+
+    async def run():
+        started = time.monotonic()
+        await main.quiz_generator(NS(callback_query=query), None, NS(lecture=LECTURE))
+        handler_seconds = time.monotonic() - started
+        await main.quiz_jobs.drain(5)
+        return handler_seconds
+
+    return asyncio.run(run())
+
+
+def test_slow_generator_does_not_block_the_handler(main, monkeypatch):
+    query = FakeQuery()
+    assert ask_for_quiz(main, monkeypatch, query) < 0.25
+    assert query.edits[0].startswith("⏳")
+    assert "Beta\\_blockers \\*intro\\*" in query.edits[0]
+    assert query.edits[-1].startswith("🧠")
+    assert main.quiz_cache.get(main.quiz_key(LECTURE)) is not None
+
+
+def test_quiz_is_still_generated_when_the_progress_edit_fails(main, monkeypatch):
+    query = FakeQuery(fail_first_edit=True)
+    ask_for_quiz(main, monkeypatch, query, generator_delay=0)
+    assert len(query.edits) == 1 and query.edits[0].startswith("🧠")
+
+
+def test_cache_invalidation_only_drops_the_affected_quizzes(main):
+    cache = main.QuizCache(max_size=3, ttl=3600)
+    version = main.QUIZ_GENERATOR_VERSION
+    for subject, title in [("Pharm", "A"), ("Pharm", "B"), ("Micro", "A")]:
+        cache.put((subject, "document", title, version), [], title)
+    cache.on_change({"op": "add", "subject": "Pharm", "content_type": "document", "title": "A"})
+    assert cache.get(("Pharm", "document", "A", version)) is None
+    assert cache.get(("Pharm", "document", "B", version)) is not None
+    cache.on_change({"op": "rename", "old": "Pharm", "new": "Pharmacology"})
+    assert cache.get(("Pharm", "document", "B", version)) is None
+    cache.put(("Micro", "media", "C", version), [], "C")
+    cache.put(("Micro", "media", "D", version), [], "D")
+    cache.put(("Micro", "media", "E", version), [], "E")  # evicts the oldest
+    assert cache.stats()["size"] == 3 and cache.stats()["evictions"] == 1
+    cache.on_change({"op": "clear_subject", "subject": "Micro"})
+    assert cache.stats()["size"] == 0 and cache._by_lecture == {}
@@ -0,0 +1,98 @@
+import asyncio
+import json
+import threading
+
+
+def test_subject_ids_stay_dense_across_captures(main):
+    catalog = main.SqliteStorage("catalog.db")
+    for n in range(3):
+        catalog.add_lecture("Anatomy", "document", f"L{n}.pdf", n)
+    catalog.add_subject("Anatomy", thread_id=5)
+    catalog.add_lecture("Biochemistry", "document", "B.pdf", 9)
+
+    assert sorted(catalog.subjects()) == [(1, "Anatomy"), (2, "Biochemistry")]
+    assert catalog.thread_id("Anatomy") == 5
+
+
+def test_json_catalog_imports_into_sqlite(main):
+    source = main.JsonStorage("source.json")
+    source.add_subject("Anatomy", thread_id=5)
+    source.add_subject("Empty")
+    source.add_lecture("Anatomy", "document", "Intro.pdf", 7)
+    source.add_lecture("Anatomy", "media", "Dissection.mp4", 8, thread_id=5,
+                       file={"file_id": "F", "file_unique_id": "U", "kind": "video"})
+    source.incr_stat("total_forwards", 12)
+    asyncio.run(source.flush())
+
+    catalog = main.SqliteStorage("catalog.db")
+    assert main.import_json_catalog(catalog, "source.json") == 2
+    assert sorted(catalog.subject_names()) == ["Anatomy", "Empty"]
+    assert catalog.thread_id("Anatomy") == 5
+    assert catalog.get_lecture("Anatomy", "document", "Intro.pdf")["message_id"] == 7
+    assert catalog.get_lecture("Anatomy", "media", "Dissection.mp4")["file"]["file_id"] == "F"
+    assert catalog.get_stat("total_forwards") == 12
+
+
+def test_pre_schema_json_catalog_imports_into_sqlite(main, tmp_path):
+    (tmp_path / "old.json").write_text(json.dumps({
+        "Anatomy": {"thread_id": None, "lectures": {"Intro.pdf": 7}},
+        "_stats": {"total_forwards": 3},
+    }))
+    catalog = main.SqliteStorage("catalog.db")
+    assert main.import_json_catalog(catalog, "old.json") == 1
+    assert catalog.get_lecture("Anatomy", "document", "Intro.pdf")["message_id"] == 7
+
+
+def test_workers_starting_together_import_the_json_catalog_once(main):
+    source = main.JsonStorage("source.json")
+    for n in range(500):
+        source.add_lecture("Anatomy", "document", f"L{n}.pdf", n)
+    asyncio.run(source.flush())
+    barrier = threading.Barrier(4)
+    imported, errors = [], []
+
+    def start_worker():
+        try:
+            catalog = main.SqliteStorage("catalog.db", shared=True)
+            barrier.wait()
+            imported.append(catalog.import_json_once("source.json"))
+        except Exception as e:
+            errors.append(e)
+
+    workers = [threading.Thread(target=start_worker) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert errors == []
+    assert sorted(imported) == [0, 0, 0, 500]
+    assert sum(main.SqliteStorage("catalog.db").lecture_counts("Anatomy")) == 500
+
+
+def test_emptied_catalog_is_not_imported_again(main):
+    source = main.JsonStorage("source.json")
+    source.add_lecture("Anatomy", "document", "Intro.pdf", 7)
+    asyncio.run(source.flush())
+    catalog = main.SqliteStorage("catalog.db")
+    assert catalog.import_json_once("source.json") == 1
+    catalog.delete_subject("Anatomy")
+
+    assert main.SqliteStorage("catalog.db").import_json_once("source.json") == 0
+
+
+def test_other_processes_changes_reach_the_listeners(main, monkeypatch):
+    writer = main.SqliteStorage("catalog.db", shared=True)
+    reader = main.SqliteStorage("catalog.db", shared=True)
+    events = []
+    reader.listeners.append(events.append)
+
+    monkeypatch.setattr(main, "WORKER_ID", "worker-0")
+    lecture_id = writer.add_lecture("Anatomy", "document", "Intro.pdf", 7)
+    assert writer.poll_changes() == 0  # its own events are skipped
+
+    monkeypatch.setattr(main, "WORKER_ID", "worker-1")
+    assert reader.poll_changes() == 2
+    assert [event["op"] for event in events] == ["add_subject", "add"]
+    assert events[1]["id"] == lecture_id
+    assert reader.poll_changes() == 0
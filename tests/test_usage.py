@@ -0,0 +1,49 @@
+import asyncio
+
+
+def test_merged_sketches_count_each_student_once(main):
+    first, second = main.HyperLogLog(), main.HyperLogLog()
+    for user_id in range(0, 10000):
+        first.add(user_id)
+    for user_id in range(5000, 15000):
+        second.add(user_id)
+    first.merge(second)
+    assert abs(first.count() - 15000) < 15000 * 0.05
+
+
+def test_unused_lectures_follow_adds_sends_and_deletes(main):
+    catalog = main.JsonStorage("catalog.json")
+    catalog.add_subject("Pharmacology")
+    intro = catalog.add_lecture("Pharmacology", "document", "Intro.pdf", 7)
+    usage = main.UsageStats(None, catalog)
+    catalog.listeners.append(usage.on_change)
+
+    second = catalog.add_lecture("Pharmacology", "document", "Second.pdf", 8)
+    third = catalog.add_lecture("Pharmacology", "media", "Third.mp4", 9)
+    assert usage.unused_lectures(0, 10) == [intro, second, third]
+
+    usage.record(42, [second], catalog.subject_id("Pharmacology"))
+    catalog.delete_lecture("Pharmacology", "media", "Third.mp4")
+    assert usage.unused_lectures(0, 10) == [intro]
+
+    catalog.rename_subject("Pharmacology", "Pharma")
+    catalog.delete_subject("Pharma")
+    assert usage.unused == {}
+
+
+def test_forwards_are_kept_when_adding_them_fails(main, monkeypatch):
+    catalog = main.JsonStorage("catalog.json")
+    usage = main.UsageStats(None, catalog)
+    usage.record(42, [1, 2], None)
+    incr_stat = catalog.incr_stat
+
+    def locked(name, n=1):
+        raise main.sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(catalog, "incr_stat", locked)
+    asyncio.run(usage.flush())
+    assert usage.unflushed == 2
+
+    monkeypatch.setattr(catalog, "incr_stat", incr_stat)
+    asyncio.run(usage.flush())
+    assert usage.unflushed == 0 and catalog.get_stat("total_forwards") == 2
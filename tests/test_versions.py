@@ -0,0 +1,12 @@
+def test_confirmations_from_before_a_restart_are_stale(main, tmp_path, monkeypatch):
+    before = main.JsonStorage(str(tmp_path / "before.json"))
+    before.add_subject("Pharmacology")
+    shown = before.subject_version("Pharmacology")
+    assert before.subject_version("Pharmacology") == shown
+
+    # Same number of changes since start, one restart later
+    clock = main.time.time() + 60
+    monkeypatch.setattr(main.time, "time", lambda: clock)
+    after = main.JsonStorage(str(tmp_path / "after.json"))
+    after.add_subject("Pharmacology")
+    assert after.subject_version("Pharmacology") != shown
@@ -0,0 +1,71 @@
+import asyncio
+import json
+import socket
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("tornado")  # python-telegram-bot[webhooks]
+import httpx
+from telegram.request import BaseRequest
+
+UPDATE = Path(__file__).parent / "fixtures" / "update_start.json"
+RESULTS = {
+    "getMe": {"id": 1, "is_bot": True, "first_name": "Lectures", "username": "lecture_bot"},
+    "sendMessage": {"message_id": 2, "date": 1700000000, "chat": {"id": 42, "type": "private"}, "text": "ok"},
+}
+
+
+class FakeBotApi(BaseRequest):
+    """Answers every Bot API call locally and records (method, parameters)."""
+
+    def __init__(self):
+        self.calls = []
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls.append((endpoint, request_data.parameters if request_data else {}))
+        return 200, json.dumps({"ok": True, "result": RESULTS.get(endpoint, True)}).encode()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_update_posted_to_the_webhook_is_handled(main):
+    api = FakeBotApi()
+    port = free_port()
+
+    async def run():
+        app = main.build_application(request=api)
+        async with app:
+            await app.updater.start_webhook(listen="127.0.0.1", port=port, url_path=main.WEBHOOK_PATH,
+                                            secret_token="s3cret")
+            await app.start()
+            try:
+                async with httpx.AsyncClient() as client:
+                    url = f"http://127.0.0.1:{port}/{main.WEBHOOK_PATH}"
+                    headers = {"Content-Type": "application/json"}
+                    rejected = await client.post(url, content=UPDATE.read_bytes(), headers=headers)
+                    accepted = await client.post(url, content=UPDATE.read_bytes(),
+                                                 headers={**headers, "X-Telegram-Bot-Api-Secret-Token": "s3cret"})
+                for _ in range(100):
+                    if any(method == "sendMessage" for method, _ in api.calls):
+                        break
+                    await asyncio.sleep(0.05)
+            finally:
+                await app.updater.stop()
+                await app.stop()
+        return rejected.status_code, accepted.status_code
+
+    assert asyncio.run(run()) == (403, 200)
+    [reply] = [params for method, params in api.calls if method == "sendMessage"]
+    assert reply["chat_id"] == 42